@@ -4,69 +4,314 @@ import argparse
 import sys
 from pathlib import Path
 import logging
-from typing import List  # Add this import for proper type hints
+from typing import Dict, Optional, Sequence, Tuple  # Add this import for proper type hints
 import shutil
+import stat
+import codecs
+import contextlib
+import io
+import re
+import runpy
+import shlex
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 # Setup basic logging for the wrapper script
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def run_script(script_path: Path, args: List[str] = [], cwd: Path = None, script_name: str = "") -> bool:
-    """Runs a Python script using subprocess, handling potential errors."""
-    if not script_path.is_file():
-        logging.error(f"Script not found: {script_path}")
+# Script output forwarded by _LogWriter goes through this logger rather than the root logger,
+# so handlers a script installs on the root logger (bound to the redirected sys.stderr) never
+# see the forwarded lines again and loop back into the writer.
+_SCRIPT_OUTPUT_LOG = logging.getLogger("run_automation.script_output")
+
+# Leading letters of the input identifier, e.g. "JF" in "JF25001"
+_PREFIX_RE = re.compile(r'^[A-Za-z]+')
+
+def _probe(path: str) -> Tuple[bool, bool, bool]:
+    """Returns (exists, is_file, is_dir) for a path using a single stat() call."""
+    try:
+        st = os.stat(path)
+    except (OSError, ValueError):
+        return (False, False, False)
+    return (True, stat.S_ISREG(st.st_mode), stat.S_ISDIR(st.st_mode))
+
+
+def _scan_dir(directory: Path) -> Dict[str, os.DirEntry]:
+    """Lists a directory in one scandir() call, keyed by case-normalized name (empty if unreadable)."""
+    try:
+        with os.scandir(directory) as entries:
+            return {os.path.normcase(entry.name): entry for entry in entries}
+    except OSError:
+        return {}
+
+
+def _has_entry(directory: Path, entries: Dict[str, os.DirEntry], name: str, want_dir: bool = False) -> bool:
+    """Checks a _scan_dir() listing of directory for a file (or directory).
+
+    DirEntry caches the type, so a hit is free. A miss falls back to a real check, because on a
+    case-insensitive filesystem other than Windows (e.g. macOS) "Template" still matches "TEMPLATE".
+    """
+    entry = entries.get(os.path.normcase(name))
+    if entry is None:
+        path = directory / name
+        return os.path.isdir(path) if want_dir else os.path.isfile(path)
+    try:
+        return entry.is_dir() if want_dir else entry.is_file()
+    except OSError:
         return False
 
-    command = [sys.executable, str(script_path)] + args
-    script_name = script_name or script_path.name
-    logging.info(f"Running {script_name}...")
-    logging.info(f"  Command: {' '.join(command)}")
+
+@contextlib.contextmanager
+def _script_context(script_path: Path, args: Sequence[str], cwd: Optional[Path] = None):
+    """Temporarily sets argv, sys.path, the working directory and the root logger as if the script
+    were launched directly."""
+    root_logger = logging.getLogger()
+    saved_root_handlers = list(root_logger.handlers)
+    saved_root_level = root_logger.level
+    saved_argv = sys.argv
+    saved_path = list(sys.path)
+    saved_cwd = os.getcwd()
+    saved_modules = set(sys.modules)
+    script_dir = str(script_path.parent)
+    script_dir_prefix = os.path.join(script_dir, "")
+
+    sys.argv = [str(script_path), *args]
+    sys.path.insert(0, script_dir)
     if cwd:
-        # Ensure CWD exists before running
-        if not Path(cwd).is_dir():
-             logging.error(f"Working directory not found for {script_name}: {cwd}")
-             return False
-        logging.info(f"  Working Directory: {cwd}")
+        os.chdir(cwd)
+    # The script gets a root logger like a fresh interpreter's (no handlers, WARNING), so its own
+    # logging.basicConfig() takes effect. Forwarded output keeps using the wrapper's handlers.
+    _SCRIPT_OUTPUT_LOG.handlers = saved_root_handlers
+    _SCRIPT_OUTPUT_LOG.setLevel(root_logger.getEffectiveLevel())
+    _SCRIPT_OUTPUT_LOG.propagate = False
+    root_logger.handlers = []
+    root_logger.setLevel(logging.WARNING)
+    try:
+        yield
+    finally:
+        # Drop (and close) whatever handlers the script installed; they point at the dead writers
+        for handler in root_logger.handlers:
+            if handler not in saved_root_handlers:
+                handler.close()
+        root_logger.handlers = saved_root_handlers
+        root_logger.setLevel(saved_root_level)
+        _SCRIPT_OUTPUT_LOG.handlers = []
+        _SCRIPT_OUTPUT_LOG.setLevel(logging.NOTSET)
+        _SCRIPT_OUTPUT_LOG.propagate = True
+        os.chdir(saved_cwd)
+        sys.argv = saved_argv
+        sys.path[:] = saved_path
+        # Forget the script's own modules so the next script gets a clean import of its
+        # sibling files (create_json and invoice_gen may share module names). Third-party
+        # packages such as openpyxl/pandas stay loaded and are reused by later runs.
+        for name in set(sys.modules) - saved_modules:
+            module_file = getattr(sys.modules[name], "__file__", None) or ""
+            if module_file.startswith(script_dir_prefix):
+                del sys.modules[name]
+
+
+class _LogWriterBuffer(io.BufferedIOBase):
+    """Binary view of a _LogWriter, for scripts that write bytes to sys.stdout.buffer."""
+
+    def __init__(self, text_writer: "_LogWriter"):
+        super().__init__()
+        self._text_writer = text_writer
+        self._decoder = codecs.getincrementaldecoder(text_writer.encoding)(text_writer.errors)
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._text_writer.write(self._decoder.decode(bytes(data)))
+        return len(data)
+
+    def decode_tail(self) -> str:
+        """Returns whatever is left of an incomplete multi-byte sequence."""
+        return self._decoder.decode(b"", final=True)
+
+
+class _LogWriter(io.TextIOBase):
+    """Text stream that forwards each complete line written to it to the logger as it arrives.
+
+    It stands in for sys.stdout/sys.stderr during in-process runs, so it also offers the parts of
+    the console stream API scripts commonly touch (encoding, errors, buffer, reconfigure, isatty).
+    There is no real file descriptor behind it: fileno() raises io.UnsupportedOperation.
+    """
+
+    encoding = 'utf-8'
+    errors = 'replace'
+
+    def __init__(self, script_name: str, level: int):
+        super().__init__()
+        self.script_name = script_name
+        self.level = level
+        self.lines_logged = 0
+        # Chunks written since the last newline; joined only once a line is complete
+        self._pending = []
+        self.buffer = _LogWriterBuffer(self)
+
+    def writable(self) -> bool:
+        return True
+
+    def isatty(self) -> bool:
+        return False
+
+    def reconfigure(self, **kwargs):
+        """Accepted for compatibility (e.g. reconfigure(encoding="utf-8")); text is logged as str anyway."""
+
+    def write(self, text: str) -> int:
+        if "\n" not in text:
+            # e.g. "\r" progress updates: just queue the chunk, don't rescan what is pending
+            if text:
+                self._pending.append(text)
+            return len(text)
+        first, *lines = text.split("\n")
+        tail = lines.pop()
+        self._pending.append(first)
+        self._emit("".join(self._pending))
+        for line in lines:
+            self._emit(line)
+        self._pending = [tail] if tail else []
+        return len(text)
+
+    def drain(self):
+        """Logs any trailing text that was not terminated by a newline."""
+        tail = self.buffer.decode_tail()
+        if tail:
+            self.write(tail)
+        if self._pending:
+            self._emit("".join(self._pending))
+            self._pending = []
+
+    def _emit(self, line: str):
+        self.lines_logged += 1
+        if _SCRIPT_OUTPUT_LOG.isEnabledFor(self.level):
+            _SCRIPT_OUTPUT_LOG.log(self.level, "[%s] %s", self.script_name, line.rstrip())
+
+
+def _pump(stream, writer: _LogWriter):
+    """Copies a child process pipe into a _LogWriter line by line until EOF."""
+    for line in stream:
+        writer.write(line)
+    writer.drain()
+    stream.close()
+
+
+def _run_in_process(script_path: Path, args: Sequence[str], cwd: Optional[Path], script_name: str) -> bool:
+    """Executes the script's __main__ block inside this interpreter, streaming its output to the log."""
+    if args and logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info("  Arguments: %s", shlex.join(args))
+
+    # Treat stderr as warning unless script explicitly failed
+    stdout_writer = _LogWriter(script_name, logging.INFO)
+    stderr_writer = _LogWriter(script_name, logging.WARNING)
+    exit_code = 0
+    try:
+        with _script_context(script_path, args, cwd), \
+                contextlib.redirect_stdout(stdout_writer), \
+                contextlib.redirect_stderr(stderr_writer):
+            runpy.run_path(str(script_path), run_name="__main__")
+    except SystemExit as e:
+        # Mirror the interpreter: None/0 is success, an int is the return code, anything else is 1
+        if e.code is None:
+            exit_code = 0
+        elif isinstance(e.code, int):
+            exit_code = e.code
+        else:
+            stderr_writer.write(f"{e.code}\n")
+            exit_code = 1
+    except Exception:
+        stdout_writer.drain()
+        stderr_writer.drain()
+        # exc_info lets the handler format the traceback only if the record is emitted
+        logging.error("Error running %s (unhandled exception):", script_name, exc_info=True)
+        return False
+    stdout_writer.drain()
+    stderr_writer.drain()
+
+    if exit_code != 0:
+        logging.error("Error running %s (Return Code: %s). See its output above.", script_name, exit_code)
+        return False
+
+    if not stdout_writer.lines_logged:
+        logging.info("%s produced no standard output.", script_name)
+    logging.info("%s completed successfully.", script_name)
+    return True
+
+
+def _run_subprocess(script_path: Path, args: Sequence[str], cwd: Optional[Path], script_name: str) -> bool:
+    """Runs the script in a separate Python interpreter, streaming its output to the log."""
+    # -u: a Python child block-buffers stdout when it is a pipe; bufsize=1 below only
+    # affects our end, so without it output would still arrive when the child exits.
+    command = [sys.executable, "-u", str(script_path), *args]
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info("  Command: %s", shlex.join(command))
 
     try:
-        # Use encoding and error handling for robustness
-        result = subprocess.run(
+        # Use encoding and error handling for robustness; line-buffered reads on our side
+        proc = subprocess.Popen(
             command,
-            capture_output=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
             text=True,
-            check=True,
             cwd=cwd,
             encoding='utf-8',
-            errors='replace'
+            errors='replace',
+            bufsize=1
         )
+    except FileNotFoundError:
+        # This might catch python executable not found, unlikely for script path due to initial check
+        logging.error("Error: Could not find executable '%s' or script '%s' during execution.", sys.executable, script_path)
+        return False
 
-        stdout_content = result.stdout.strip() if result.stdout else ""
-        stderr_content = result.stderr.strip() if result.stderr else ""
+    # Read both pipes concurrently so neither can fill up and block the child
+    stdout_writer = _LogWriter(script_name, logging.INFO)
+    stderr_writer = _LogWriter(script_name, logging.WARNING)
+    readers = [
+        threading.Thread(target=_pump, args=(proc.stdout, stdout_writer), daemon=True),
+        threading.Thread(target=_pump, args=(proc.stderr, stderr_writer), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+    returncode = proc.wait()
+    for reader in readers:
+        reader.join()
 
-        if stdout_content:
-            logging.info(f"{script_name} Output:\n--- START ---\n{stdout_content}\n--- END ---")
-        else:
-             logging.info(f"{script_name} produced no standard output.")
+    if returncode != 0:
+        logging.error("Error running %s (Return Code: %s). See its output above.", script_name, returncode)
+        return False
 
-        if stderr_content:
-            # Treat stderr as warning unless script explicitly failed (check=True handles that)
-            logging.warning(f"{script_name} Stderr:\n--- START ---\n{stderr_content}\n--- END ---")
+    if not stdout_writer.lines_logged:
+        logging.info("%s produced no standard output.", script_name)
+    logging.info("%s completed successfully.", script_name)
+    return True
 
-        logging.info(f"{script_name} completed successfully.")
-        return True
 
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Error running {script_name} (Return Code: {e.returncode}):")
-        stdout_content = e.stdout.strip() if e.stdout else "No stdout captured."
-        stderr_content = e.stderr.strip() if e.stderr else "No stderr captured."
-        logging.error(f"Stdout:\n{stdout_content}")
-        logging.error(f"Stderr:\n{stderr_content}")
-        return False
-    except FileNotFoundError:
-        # This might catch python executable not found, unlikely for script path due to initial check
-        logging.error(f"Error: Could not find executable '{sys.executable}' or script '{script_path}' during execution.")
+def run_script(script_path: Path, args: Sequence[str] = (), cwd: Optional[Path] = None, script_name: str = "",
+               use_subprocess: bool = False, validate: bool = True) -> bool:
+    """Runs a Python script in-process (or via subprocess when requested), handling potential errors.
+
+    Pass validate=False when the caller has already checked that script_path and cwd exist.
+    """
+    if validate and not _probe(str(script_path))[1]:
+        logging.error("Script not found: %s", script_path)
         return False
+
+    script_name = script_name or script_path.name
+    logging.info("Running %s...", script_name)
+    if cwd:
+        # Ensure CWD exists before running
+        if validate and not _probe(str(cwd))[2]:
+             logging.error("Working directory not found for %s: %s", script_name, cwd)
+             return False
+        logging.info("  Working Directory: %s", cwd)
+
+    try:
+        if use_subprocess:
+            return _run_subprocess(script_path, args, cwd, script_name)
+        return _run_in_process(script_path, args, cwd, script_name)
     except Exception as e:
-        logging.error(f"An unexpected error occurred while trying to run {script_name}: {e}")
+        logging.error("An unexpected error occurred while trying to run %s: %s", script_name, e)
         return False
 
 
@@ -90,56 +335,66 @@ def main():
         action="store_true",
         help="Pass --custom flag to invoice_gen/generate_invoice.py."
     )
+    parser.add_argument(
+        "--subprocess",
+        action="store_true",
+        help="Run create_json and invoice_gen in separate Python processes instead of in-process. "
+             "Use this for scripts that need a real console stream (e.g. sys.stdout.fileno())."
+    )
 
     args = parser.parse_args()
     
     # Get the input file path and create output directory based on input filename
-    input_excel_path = Path(args.input).resolve()
-    if not input_excel_path.is_file():
+    input_excel_path = Path(args.input).absolute()
+    if not os.path.isfile(input_excel_path):
         logging.error(f"Input Excel file not found: {input_excel_path}")
         sys.exit(1)
     
     # Create output directory with same name as input file (without extension)
     output_dir = input_excel_path.parent / input_excel_path.stem
-    output_dir.mkdir(parents=True, exist_ok=True)
     
     # Define all required directories relative to the output directory
     json_output_dir = output_dir / "json_output"
     invoice_output_dir = output_dir / "invoice_output"
     
-    # Create required directories
-    json_output_dir.mkdir(parents=True, exist_ok=True)
-    invoice_output_dir.mkdir(parents=True, exist_ok=True)
+    # Create required directories (creating the leaves also creates output_dir)
+    os.makedirs(json_output_dir, exist_ok=True)
+    os.makedirs(invoice_output_dir, exist_ok=True)
     
     # --- Define Project Structure & Validate Paths ---
-    project_root = Path(__file__).parent.resolve()
+    project_root = Path(__file__).parent.absolute()
     create_json_dir = project_root / "create_json"
     invoice_gen_dir = project_root / "invoice_gen"
     create_json_script = create_json_dir / "main.py"
     invoice_gen_script = invoice_gen_dir / "generate_invoice.py"
-    template_dir = project_root / "invoice_gen" / "TEMPLATE"
-    config_dir = project_root / "invoice_gen" / "config"
+    template_dir = invoice_gen_dir / "TEMPLATE"
+    config_dir = invoice_gen_dir / "config"
     
     # Get the identifier from the input filename
     identifier = input_excel_path.stem
     
     # Extract the prefix (e.g., "JF" from "JF25001")
-    prefix = ''.join(filter(str.isalpha, identifier))
+    prefix_match = _PREFIX_RE.match(identifier)
+    prefix = prefix_match.group(0) if prefix_match else ''
     if not prefix:
         logging.error(f"Could not extract prefix from filename: {identifier}")
         sys.exit(1)
 
-    # Validate paths that must exist beforehand
-    if not create_json_script.is_file():
+    # Validate paths that must exist beforehand. Everything lives directly in the two
+    # script directories, so one listing of each answers all of the checks below.
+    # (This also covers the scripts' working directories, so run_script skips re-checking.)
+    create_json_entries = _scan_dir(create_json_dir)
+    invoice_gen_entries = _scan_dir(invoice_gen_dir)
+    if not _has_entry(create_json_dir, create_json_entries, create_json_script.name):
         logging.error(f"JSON creation script not found: {create_json_script}")
         sys.exit(1)
-    if not invoice_gen_script.is_file():
+    if not _has_entry(invoice_gen_dir, invoice_gen_entries, invoice_gen_script.name):
         logging.error(f"Invoice generation script not found: {invoice_gen_script}")
         sys.exit(1)
-    if not template_dir.is_dir():
+    if not _has_entry(invoice_gen_dir, invoice_gen_entries, template_dir.name, want_dir=True):
         logging.error(f"Template directory not found: {template_dir}")
         sys.exit(1)
-    if not config_dir.is_dir():
+    if not _has_entry(invoice_gen_dir, invoice_gen_entries, config_dir.name, want_dir=True):
         logging.error(f"Configuration directory not found: {config_dir}")
         logging.error("Please ensure the directory exists and is correct.")
         sys.exit(1)
@@ -150,13 +405,14 @@ def main():
         "--output-dir", str(json_output_dir)
     ]
     logging.info(f"Running JSON creation step using input: {input_excel_path}")
-    if not run_script(create_json_script, args=create_json_args, cwd=create_json_dir, script_name="create_json"):
+    if not run_script(create_json_script, args=create_json_args, cwd=create_json_dir, script_name="create_json",
+                      use_subprocess=args.subprocess, validate=False):
         logging.error("JSON creation script failed. Aborting.")
         sys.exit(1)
 
     # --- Step 2: Verify JSON Output ---
     expected_json_path = json_output_dir / f"{identifier}.json"
-    if not expected_json_path.is_file():
+    if not os.path.isfile(expected_json_path):
         logging.error(f"Expected JSON output file was not found: {expected_json_path}")
         logging.error("Check the output/logs of the create_json script for errors.")
         sys.exit(1)
@@ -165,41 +421,66 @@ def main():
     # --- Step 3: Verify Expected Config for invoice_gen ---
     expected_config_path = config_dir / f"{prefix}_config.json"
     logging.info(f"Invoice generation step will expect config file: {expected_config_path}")
-    if not expected_config_path.is_file():
+    if not os.path.isfile(expected_config_path):
         logging.error(f"Expected config file '{expected_config_path}' not found in '{config_dir}'.")
         logging.error("Please ensure the required config file exists.")
         sys.exit(1)
 
     # --- Step 4: Run invoice_gen/generate_invoice.py for each mode ---
     modes = [
-        ("normal", []),
-        ("fob", ["--fob"]),
-        ("custom", ["--custom"])
+        ("normal", "Normal", []),
+        ("fob", "FOB", ["--fob"]),
+        ("custom", "Custom", ["--custom"])
+    ]
+    # Output paths use the naming convention "CT&INV&PL <identifier> <MODE>.xlsx";
+    # built once and shared by the generation loop and the final summary.
+    mode_specs = [
+        (mode, label, flags, invoice_output_dir / f"CT&INV&PL {identifier} {mode.upper()}.xlsx")
+        for mode, label, flags in modes
     ]
     
-    for mode, flags in modes:
-        logging.info(f"--- Processing {mode.upper()} mode ---")
-        
-        # Prepare invoice generation arguments with new naming convention
-        output_filename = f"CT&INV&PL {identifier} {mode.upper()}.xlsx"
-        invoice_gen_args = [
-            str(expected_json_path),
-            "--output", str(invoice_output_dir / output_filename),
-            "--templatedir", str(template_dir),
-            "--configdir", str(config_dir),
-        ] + flags
-        
-        logging.info(f"Running Invoice generation step to create: {output_filename}")
-        if not run_script(invoice_gen_script, args=invoice_gen_args, cwd=invoice_gen_dir, script_name="invoice_gen"):
-            logging.error(f"Invoice generation script failed for {mode} mode.")
-            continue
+    # The modes share no mutable state and write distinct files, so run them side by side.
+    # In-process runs need separate processes to keep openpyxl's Python-heavy workbook handling
+    # off a shared GIL. With --subprocess each mode already gets its own interpreter and the
+    # worker only waits on it, so threads avoid starting a second process per mode.
+    executor_class = ThreadPoolExecutor if args.subprocess else ProcessPoolExecutor
+    with executor_class(max_workers=min(len(mode_specs), os.cpu_count() or 1)) as executor:
+        futures = {}
+        for mode, label, flags, output_path in mode_specs:
+            # Prepare invoice generation arguments
+            invoice_gen_args = [
+                str(expected_json_path),
+                "--output", str(output_path),
+                "--templatedir", str(template_dir),
+                "--configdir", str(config_dir),
+            ] + flags
+
+            # Workers start right away and their output interleaves; each line is tagged
+            # with "invoice_gen (<mode>)", so only the submission is announced here.
+            logging.info(f"Submitting {mode.upper()} mode to create: {output_path.name}")
+            future = executor.submit(run_script, invoice_gen_script, args=invoice_gen_args, cwd=invoice_gen_dir,
+                                     script_name=f"invoice_gen ({mode})", use_subprocess=args.subprocess,
+                                     validate=False)
+            futures[future] = mode
+
+        for future in as_completed(futures):
+            mode = futures[future]
+            try:
+                succeeded = future.result()
+            except Exception as e:
+                logging.error(f"Invoice generation worker crashed for {mode} mode: {e}")
+                succeeded = False
+            if not succeeded:
+                # Keep going: a failure in one mode must not abort the others
+                logging.error(f"Invoice generation script failed for {mode} mode.")
+            else:
+                logging.info(f"--- {mode.upper()} mode finished ---")
 
     logging.info("--- Automation Completed Successfully ---")
     logging.info(f"All outputs saved in directory: {output_dir}")
     logging.info("Generated three versions:")
-    logging.info(f"1. Normal: CT&INV&PL {identifier} NORMAL.xlsx")
-    logging.info(f"2. FOB: CT&INV&PL {identifier} FOB.xlsx")
-    logging.info(f"3. Custom: CT&INV&PL {identifier} CUSTOM.xlsx")
+    for number, (_, label, _, output_path) in enumerate(mode_specs, start=1):
+        logging.info(f"{number}. {label}: {output_path.name}")
 
 if __name__ == "__main__":
     main()